@@ -3,32 +3,66 @@
 
 import numpy as np
 import torch 
+import functools
+import collections
 import os, io, subprocess
 import os.path
 torch.set_num_threads(int(os.environ['OMP_NUM_THREADS']))
+# set CMPO_COMPILE=1 to build act and the K matrices with torch.compile
+use_compile = bool(int(os.environ.get('CMPO_COMPILE', '0'))) and hasattr(torch, 'compile')
+# set CMPO_GRAD_FP32=1 to form the gradient of LogTrExpm in single precision for float64 inputs
+grad_fp32 = bool(int(os.environ.get('CMPO_GRAD_FP32', '0')))
+
+_compiled_fns = {}
+def _specialized(fn, *key):
+    """ fn itself, or with CMPO_COMPILE=1 fn compiled for the fixed shapes, dtype and device in key
+    """
+    if not use_compile:
+        return fn
+    key = (fn,) + key
+    if key not in _compiled_fns:
+        _compiled_fns[key] = torch.compile(fn, dynamic=False, mode='max-autotune-no-cudagraphs')
+    return _compiled_fns[key]
+
+@functools.lru_cache(maxsize=32)
+def _eye(n, dtype, device):
+    """ identity matrix shared between calls, never modify it in place
+    """
+    return torch.eye(n, dtype=dtype, device=device)
 
 def eigensolver(M):
     """ Eigensolver
         manually symmetrize M before the eigen decomposition
+        M can be a single matrix or a batch of matrices
     """
-    return torch.symeig(0.5*(M+M.t()), eigenvectors=True)
+    return torch.linalg.eigh((M + M.transpose(-2, -1)).mul_(0.5))
 
 class LogTrExpm(torch.autograd.Function):
+    """ log tr exp(beta*mat), mat can be a batch of matrices of shape B x D x D
+    """
     @staticmethod
     def forward(self, beta, mat):
         dtype, device = mat.dtype, mat.device
         #rho = torch.matrix_exp(beta*mat)
         #tr_rho = torch.trace(rho)
         w, v = eigensolver(mat)
-        y = torch.logsumexp(beta*w, dim=0)
-        scaled_rho = beta * v @ torch.diag(torch.exp(beta*w-y)) @ v.t()
-        self.save_for_backward(scaled_rho)
+        y = torch.logsumexp(beta*w, dim=-1)
+        # scaled_rho only enters the gradient, skip it for plain evaluations
+        if self.needs_input_grad[1]:
+            if grad_fp32 and dtype == torch.float64:
+                # eigh and logsumexp stay in double precision
+                v = v.float()
+            p = (beta*w - y.unsqueeze(-1)).exp_().to(v.dtype)
+            vp = v * p.unsqueeze(-2)
+            del p
+            scaled_rho = torch.matmul(vp.mul_(beta), v.transpose(-2, -1))
+            self.save_for_backward(scaled_rho)
         return y
 
     @staticmethod
     def backward(self, dy):
         scaled_rho = self.saved_tensors[0]
-        dmat = dy * scaled_rho.t()
+        dmat = dy[..., None, None] * scaled_rho.transpose(-2, -1).to(dy.dtype)
         return None, dmat
 
 class cmpo(object):
@@ -125,7 +159,8 @@ def multiply(W, mps):
              --        --   --            --
     """
     dtype, device = mps.dtype, mps.device
-    R1 = torch.einsum('mn, nab->mab', W, mps.R)
+    d, D = mps.R.shape[0], mps.dim
+    R1 = (W @ mps.R.reshape(d, D*D)).view(-1, D, D)
     return cmps(mps.Q, R1)
 
 def act(mpo, mps):
@@ -141,17 +176,30 @@ def act(mpo, mps):
     dtype, device = mps.dtype, mps.device
     Do, Ds = mpo.dim, mps.dim
     d = mps.R.shape[0]
-    Io = torch.eye(Do, dtype=dtype, device=device) 
-    Is = torch.eye(Ds, dtype=dtype, device=device)
-
-    Q_rslt = torch.einsum('ab,cd->acbd', mpo.Q, Is).contiguous().view(Do*Ds, Do*Ds) \
-           + torch.einsum('ab,cd->acbd', Io, mps.Q).contiguous().view(Do*Ds, Do*Ds) \
-           + torch.einsum('mab,mcd->acbd', mpo.R, mps.R).contiguous().view(Do*Ds, Do*Ds) 
-    R_rslt = torch.einsum('mab,mcd->macbd', mpo.L, Is.repeat(d,1,1)).contiguous().view(d, Do*Ds, Do*Ds) \
-           + torch.einsum('mnab,ncd->macbd', mpo.P, mps.R).contiguous().view(d, Do*Ds, Do*Ds)
+    Io = _eye(Do, dtype, device)
+    Is = _eye(Ds, dtype, device)
 
+    act_impl = _specialized(_act_impl, Do, Ds, d, dtype, device)
+    Q_rslt, R_rslt = act_impl(mpo.Q, mpo.L, mpo.R, mpo.P, mps.Q, mps.R, Io, Is)
     return cmps(Q_rslt, R_rslt)
 
+def _act_impl(Qo, Lo, Ro, Po, Qs, Rs, Io, Is):
+    """ the Q and R tensors of act, written in plain tensors so that it can be compiled
+    """
+    Do, Ds, d = Qo.shape[0], Qs.shape[0], Rs.shape[0]
+
+    # sum_m R_o[m] x R_s[m] as a single GEMM over the m axis
+    RR = Ro.reshape(d, Do*Do).t() @ Rs.reshape(d, Ds*Ds)
+    Q_rslt = torch.kron(Qo, Is)
+    Q_rslt.add_(torch.kron(Io, Qs))
+    Q_rslt.add_(RR.view(Do, Do, Ds, Ds).permute(0, 2, 1, 3).reshape(Do*Ds, Do*Ds))
+
+    PR = torch.tensordot(Po, Rs, dims=([1], [0]))
+    R_rslt = torch.kron(Lo, Is.unsqueeze(0))
+    R_rslt.view(d, Do, Ds, Do, Ds).add_(PR.permute(0, 1, 3, 2, 4))
+
+    return Q_rslt, R_rslt
+
 def Lact(mps, mpo):
     """ act the cmps to the left of cmpo
           --            --  --                              --   
@@ -166,10 +214,20 @@ def Lact(mps, mpo):
     Do, Ds = mpo.dim, mps.dim
     d = mps.R.shape[0]
 
-    Tmps = act(mpo.t(), mps)
-    Q = torch.einsum('abcd->badc', Tmps.Q.view(Do, Ds, Do, Ds)).contiguous().view(Do*Ds, Do*Ds)
-    R = torch.einsum('mabcd->mbadc', Tmps.R.view(d, Do, Ds, Do, Ds)).contiguous().view(d, Do*Ds, Do*Ds)
-    return cmps(Q, R)
+    Io = _eye(Do, dtype, device)
+    Is = _eye(Ds, dtype, device)
+
+    # sum_m R_s[m] x L_o[m] as a single GEMM over the m axis
+    RL = mps.R.reshape(d, Ds*Ds).t() @ mpo.L.reshape(d, Do*Do)
+    Q_rslt = torch.kron(mps.Q, Io)
+    Q_rslt.add_(torch.kron(Is, mpo.Q))
+    Q_rslt.add_(RL.view(Ds, Ds, Do, Do).permute(0, 2, 1, 3).reshape(Ds*Do, Ds*Do))
+
+    RP = torch.tensordot(mps.R, mpo.P, dims=([0], [0]))
+    R_rslt = torch.kron(Is.unsqueeze(0), mpo.R)
+    R_rslt.view(d, Ds, Do, Ds, Do).add_(RP.permute(2, 0, 3, 1, 4))
+
+    return cmps(Q_rslt, R_rslt)
 
 def density_matrix(mps1, mps2):
     """ construct the K matrix corresponding to <mps1|mps2>
@@ -181,13 +239,23 @@ def density_matrix(mps1, mps2):
        --                          --  --             --     
     """
     dtype, device= mps1.dtype, mps1.device
-    D1, D2 = mps1.dim, mps2.dim
-    I1 = torch.eye(mps1.dim, dtype=dtype, device=device)
-    I2 = torch.eye(mps2.dim, dtype=dtype, device=device) 
+    I2 = _eye(mps2.dim, dtype, device)
 
-    M = torch.einsum('ab,cd->acbd', mps1.Q, I2).contiguous().view(D1*D2, D1*D2) \
-      + torch.einsum('ab,cd->acbd', I1, mps2.Q).contiguous().view(D1*D2, D1*D2) \
-      + torch.einsum('mab,mcd->acbd', mps1.R, mps2.R).contiguous().view(D1*D2, D1*D2) 
+    build_K = _specialized(_build_K, mps1.dim, mps2.dim, mps1.R.shape[0], dtype, device)
+    return build_K(mps1.Q, mps1.R, mps2.Q, mps2.R, I2)
+
+def _build_K(Q1, R1, Q2, R2, I2):
+    """ the K matrix of density_matrix, written in plain tensors so that it can be compiled
+        I1 x Q2 is added to the diagonal blocks without forming it, and the R1.R2 product
+        is added through a permuted view without a reshape copy; that product is still
+        one D1*D2 x D1*D2 temporary next to M itself
+    """
+    D1, D2 = Q1.shape[0], Q2.shape[0]
+    M = torch.kron(Q1, I2)
+    M4 = M.view(D1, D2, D1, D2)
+    # I1 x Q2 only lives on the diagonal blocks
+    M4.diagonal(dim1=0, dim2=2).add_(Q2.unsqueeze(-1))
+    M4.add_(torch.tensordot(R1, R2, dims=([0], [0])).permute(0, 2, 1, 3))
     return M
 
 def ln_ovlp(mps1, mps2, beta):
@@ -198,9 +266,17 @@ def ln_ovlp(mps1, mps2, beta):
 
 def Fidelity(psi, mps, beta):
     """ calculate log [ <psi|mps> / sqrt(<psi|psi>) ]
+        if psi and mps have the same bond dimension, e.g. in gauge checks like
+        tests/test_cmpo.py::test_project, both K matrices are diagonalized in one batch;
+        the compression routines always compare psi with a larger cMPS and take the
+        two separate calls
     """
-    up = ln_ovlp(psi, mps, beta)
-    dn = ln_ovlp(psi, psi, beta)
+    if psi.dim == mps.dim:
+        M = torch.stack([density_matrix(psi, mps), density_matrix(psi, psi)])
+        up, dn = LogTrExpm.apply(beta, M)
+    else:
+        up = ln_ovlp(psi, mps, beta)
+        dn = ln_ovlp(psi, psi, beta)
     return up - 0.5*dn
 
 def energy_cut(mps, chi):
@@ -220,14 +296,39 @@ def interpolate_cut(cut1, cut2, theta):
     U, _, V = torch.svd(mix)
     return U@V.t()
 
-def adaptive_mera_update(mps, beta, chi, tol=1e-12, maxiter=50):
+def anderson_cut(cuts, targets):
+    """ Anderson extrapolation of the SVD update P -> target(P)
+     cuts: the last few isometries P_i
+     targets: the SVD updates U@V.t() obtained at each P_i
+     mix = sum_i a_i targets_i, where a minimizes |sum_i a_i (targets_i - cuts_i)|
+     under sum_i a_i = 1, then retraction back to an isometry
+    """
+    F = torch.stack([(t - c).reshape(-1) for c, t in zip(cuts, targets)], dim=1)
+    G = F.t() @ F
+    # all residuals vanish: the latest update is already a fixed point
+    if torch.trace(G) == 0:
+        return targets[-1]
+    G.diagonal().add_(1e-12 * torch.trace(G))
+    a = torch.linalg.solve(G, torch.ones_like(G[:, :1])).view(-1)
+    a = a / a.sum()
+    mix = sum(a_i * t for a_i, t in zip(a, targets))
+    U, _, V = torch.svd(mix)
+    return U@V.t()
+
+def adaptive_mera_update(mps, beta, chi, tol=1e-12, maxiter=50, anderson=False):
     """ update the isometry using iterative SVD update with line search
         mps: the original cMPS
         beta: inverse temperature
         chi: target bond dimension
+        anderson: try an Anderson-extrapolated isometry before each line search
+                  (off by default, it does not reduce the run time in the models tested)
         return the compressed cMPS
     """
     P = energy_cut(mps, chi)
+    history = collections.deque(maxlen=3)
+    # the isometry reached by the last line search step, and whether P
+    # has been extrapolated since then
+    P_plain, extrapolated = P, False
     last = 9.9e9
     step = 0
     while step < maxiter:
@@ -252,25 +353,50 @@ def adaptive_mera_update(mps, beta, chi, tol=1e-12, maxiter=50):
         #https://mathoverflow.net/questions/262560/natural-ways-of-interpolating-unitary-matrices
         #https://groups.google.com/forum/#!topic/manopttoolbox/2zhx67doXaU
         #interpolate between unitary matrices
+        UV = U@V.t()
+
+        # try the Anderson-extrapolated isometry first, fall back to line search
+        history.append((P.detach(), UV))
+        if anderson and len(history) > 1:
+            P_test = anderson_cut(*zip(*history))
+            with torch.no_grad():
+                Fidel1_test = Fidelity(mps.project(P_test), mps, beta)
+            if Fidel1_test > Fidel0:
+                P = P_test
+                extrapolated = True
+                continue
+
         theta = np.pi
         proceed = False
         while proceed == False:
             theta = theta / 2
             if theta < np.pi / 1.9**12: 
-                theta = 0
-                P_test = P.data
-            else:
-                P_test = interpolate_cut(U@V.t(), P.data, theta)
+                if extrapolated:
+                    # the line search stalls at an extrapolated isometry: this is not 
+                    # convergence, go back to the last line search step and finish without Anderson
+                    P = P_plain
+                    anderson, extrapolated = False, False
+                    history.clear()
+                    last = 9.9e9
+                else:
+                    # theta = 0: keep the current isometry, no need to test it again
+                    P = P.data
+                proceed=True
+                continue
+
+            P_test = interpolate_cut(UV, P.data, theta)
 
             #mix = np.sin(theta) * U@V.t() + np.cos(theta) * P.data
             ##then retraction back to unitary
             #U, _, V = torch.svd(mix)
             #P_test = U@V.t()
 
-            mps_test = mps.project(P_test)
-            Fidel1_test = Fidelity(mps_test, mps, beta)
-            if Fidel1_test > Fidel0 or np.isclose(theta, 0):
+            with torch.no_grad():
+                mps_test = mps.project(P_test)
+                Fidel1_test = Fidelity(mps_test, mps, beta)
+            if Fidel1_test > Fidel0:
                 P = P_test
+                P_plain, extrapolated = P, False
                 proceed=True
 
     return mps_new 
@@ -302,13 +428,20 @@ def variational_compr(mps, beta, chi, chkp_loc, init=None, tol=1e-12):
         loss.backward()
         return loss
 
+    # the convergence check stays on the device, on GPU it is only read back every few steps
+    sync_every = 1 if Q.device.type == 'cpu' else 5
     is_converged = False
+    converged = torch.zeros((), dtype=torch.bool, device=Q.device)
     loss0 = 9.99e99
+    step = 0
     while not is_converged:
-        loss = optimizer.step(closure)
-        print('--> ' + '{:.12f}'.format(loss.item()), end='\r')
-        is_converged = np.isclose(loss.item(), loss0, rtol=tol, atol=tol)
-        loss0 = loss.item()
+        loss = optimizer.step(closure).detach()
+        converged |= (loss - loss0).abs() <= tol*(1 + loss.abs())
+        loss0 = loss
+        step += 1
+        if step % sync_every == 0:
+            print('--> ' + '{:.12f}'.format(loss.item()), end='\r')
+            is_converged = converged.item()
 
     # "normalize"
     with torch.no_grad():
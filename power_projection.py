@@ -38,7 +38,7 @@ def Obsv(psi, Lpsi, T, O, beta):
     dtype, device = psi.dtype, psi.device
     totalD = O.shape[0]*psi.dim*psi.dim
     matI = torch.eye(psi.dim, dtype=dtype, device=device)
-    matO = torch.einsum('ab,cd,ef->acebdf', matI, O, matI).contiguous().view(totalD, totalD) 
+    matO = torch.einsum('ab,cd,ef->acebdf', matI, O, matI).reshape(totalD, totalD) 
  
     Tpsi = act(T, psi)
     M = density_matrix(Lpsi, Tpsi)
@@ -62,8 +62,8 @@ def Corr(psi, Lpsi, T, O1, O2, beta, tau):
     dtype, device = psi.dtype, psi.device
     totalD = O1.shape[0]*psi.dim*psi.dim
     matI = torch.eye(psi.dim, dtype=dtype, device=device)
-    matO1 = torch.einsum('ab,cd,ef->acebdf', matI, O1, matI).contiguous().view(totalD, totalD) 
-    matO2 = torch.einsum('ab,cd,ef->acebdf', matI, O2, matI).contiguous().view(totalD, totalD) 
+    matO1 = torch.einsum('ab,cd,ef->acebdf', matI, O1, matI).reshape(totalD, totalD) 
+    matO2 = torch.einsum('ab,cd,ef->acebdf', matI, O2, matI).reshape(totalD, totalD) 
     Tpsi = act(T, psi)
     M = density_matrix(Lpsi, Tpsi)
 
@@ -91,8 +91,8 @@ def chi(psi, Lpsi, T, O1, O2, beta, iomega=0):
     dtype, device = psi.dtype, psi.device
     totalD = O1.shape[0]*psi.dim*psi.dim
     matI = torch.eye(psi.dim, dtype=dtype, device=device)
-    matO1 = torch.einsum('ab,cd,ef->acebdf', matI, O1, matI).contiguous().view(totalD, totalD) 
-    matO2 = torch.einsum('ab,cd,ef->acebdf', matI, O2, matI).contiguous().view(totalD, totalD) 
+    matO1 = torch.einsum('ab,cd,ef->acebdf', matI, O1, matI).reshape(totalD, totalD) 
+    matO2 = torch.einsum('ab,cd,ef->acebdf', matI, O2, matI).reshape(totalD, totalD) 
     Tpsi = act(T, psi)
     M = density_matrix(Lpsi, Tpsi)
 
@@ -113,8 +113,8 @@ def chi2(psi, Lpsi, T, O1, O2, beta, omega=0, eta=0.05):
     dtype, device = psi.dtype, psi.device
     totalD = O1.shape[0]*psi.dim*psi.dim
     matI = torch.eye(psi.dim, dtype=dtype, device=device)
-    matO1 = torch.einsum('ab,cd,ef->acebdf', matI, O1, matI).contiguous().view(totalD, totalD) 
-    matO2 = torch.einsum('ab,cd,ef->acebdf', matI, O2, matI).contiguous().view(totalD, totalD) 
+    matO1 = torch.einsum('ab,cd,ef->acebdf', matI, O1, matI).reshape(totalD, totalD) 
+    matO2 = torch.einsum('ab,cd,ef->acebdf', matI, O2, matI).reshape(totalD, totalD) 
     Tpsi = act(T, psi)
     M = density_matrix(Lpsi, Tpsi)
 
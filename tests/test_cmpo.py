@@ -19,8 +19,113 @@ def test_project():
 
     A = torch.rand(8,8, dtype=dtype, device=device)
     A = A + A.t()
-    _, U = torch.symeig(A, eigenvectors=True)
+    _, U = torch.linalg.eigh(A)
     mps1 = mps.project(U)
    
     assert np.isclose(Fidelity(mps, mps1, beta), 0.5*ln_ovlp(mps, mps, beta))
 
+
+def test_Lact():
+    """ Check that acting a cMPS to the left of a cMPO agrees with acting it 
+        to the right of the transposed cMPO and swapping the two bond spaces
+    """
+    dtype=torch.float64
+    device='cpu'
+
+    Do, Ds, d = 3, 5, 2
+    mpo = cmpo(torch.rand(Do,Do, dtype=dtype, device=device), 
+               torch.rand(d,Do,Do, dtype=dtype, device=device), 
+               torch.rand(d,Do,Do, dtype=dtype, device=device), 
+               torch.rand(d,d,Do,Do, dtype=dtype, device=device))
+    mps = cmps(torch.rand(Ds,Ds, dtype=dtype, device=device), 
+               torch.rand(d,Ds,Ds, dtype=dtype, device=device))
+
+    Tmps = act(mpo.t(), mps)
+    Q = torch.einsum('abcd->badc', Tmps.Q.view(Do, Ds, Do, Ds)).reshape(Do*Ds, Do*Ds)
+    R = torch.einsum('mabcd->mbadc', Tmps.R.view(d, Do, Ds, Do, Ds)).reshape(d, Do*Ds, Do*Ds)
+
+    LTmps = Lact(mps, mpo)
+    assert np.allclose(LTmps.Q, Q)
+    assert np.allclose(LTmps.R, R)
+
+def test_anderson_cut():
+    """ Check that the Anderson-extrapolated cut is an isometry, and that it
+        falls back to the latest update when all residuals vanish
+    """
+    dtype=torch.float64
+    device='cpu'
+
+    iso = lambda: torch.linalg.qr(torch.rand(8,4, dtype=dtype, device=device))[0]
+    cuts = [iso() for _ in range(3)]
+    targets = [iso() for _ in range(3)]
+    P = anderson_cut(cuts, targets)
+    assert np.allclose(P.t() @ P, torch.eye(4, dtype=dtype, device=device))
+
+    P = anderson_cut(targets, targets)
+    assert torch.equal(P, targets[-1])
+
+def test_adaptive_mera_update():
+    """ Check that the Anderson acceleration does not lower the fidelity 
+        reached by the plain line search
+    """
+    from model import ising, xxz_spm
+    dtype=torch.float64
+    device='cpu'
+
+    cases = [(ising(Gamma=1.0, J=1.0, dtype=dtype, device=device).T, 3, 4.0, 4),
+             (xxz_spm(Jz=1.0, Jxy=1.0, dtype=dtype, device=device).T, 5, 20.0, 16)]
+    for T, nact, beta, chi in cases:
+        mps = cmps(T.Q, T.L)
+        for _ in range(nact): 
+            mps = act(T, mps)
+
+        psi0 = adaptive_mera_update(mps, beta, chi, anderson=False).detach()
+        psi1 = adaptive_mera_update(mps, beta, chi, anderson=True).detach()
+        assert Fidelity(psi1, mps, beta) > Fidelity(psi0, mps, beta) - 1e-6
+
+def test_Fidelity_batched():
+    """ Check that the batched Fidelity for cMPS of equal bond dimension gives
+        the same value and gradient as two separate ln_ovlp calls
+    """
+    dtype=torch.float64
+    device='cpu'
+
+    Q = torch.rand(6,6, dtype=dtype, device=device, requires_grad=True)
+    R = torch.rand(2,6,6, dtype=dtype, device=device, requires_grad=True)
+    mps = cmps(torch.rand(6,6, dtype=dtype, device=device), 
+               torch.rand(2,6,6, dtype=dtype, device=device))
+    beta = 10*torch.rand(1, dtype=dtype, device=device).item()
+    psi = cmps(Q, R)
+
+    F1 = Fidelity(psi, mps, beta)
+    dQ1, dR1 = torch.autograd.grad(F1, (Q, R))
+    F2 = ln_ovlp(psi, mps, beta) - 0.5*ln_ovlp(psi, psi, beta)
+    dQ2, dR2 = torch.autograd.grad(F2, (Q, R))
+
+    assert np.isclose(F1.item(), F2.item())
+    assert np.allclose(dQ1, dQ2)
+    assert np.allclose(dR1, dR2)
+
+def test_grad_fp32():
+    """ Check that the single-precision gradient factor of LogTrExpm agrees 
+        with the double-precision one, and that the gradient stays in float64
+    """
+    import cmpo as cmpo_module
+    dtype=torch.float64
+    device='cpu'
+
+    mps1 = cmps(torch.rand(6,6, dtype=dtype, device=device), torch.rand(2,6,6, dtype=dtype, device=device))
+    mps2 = cmps(torch.rand(8,8, dtype=dtype, device=device), torch.rand(2,8,8, dtype=dtype, device=device))
+    M = density_matrix(mps1, mps2).requires_grad_()
+    beta = 10*torch.rand(1, dtype=dtype, device=device).item()
+
+    dM64, = torch.autograd.grad(LogTrExpm.apply(beta, M), M)
+    grad_fp32 = cmpo_module.grad_fp32
+    try:
+        cmpo_module.grad_fp32 = True
+        dM32, = torch.autograd.grad(LogTrExpm.apply(beta, M), M)
+    finally:
+        cmpo_module.grad_fp32 = grad_fp32
+
+    assert dM32.dtype == torch.float64
+    assert torch.max(torch.abs(dM32 - dM64)) < 1e-6